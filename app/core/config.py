@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -8,7 +9,30 @@ class Settings(BaseSettings):
     TWILIO_SID: str
     TWILIO_AUTH_TOKEN: str
     TWILIO_PHONEAUTH_SERVICE_SID: str
+
+    # neo4j driver connection pool tuning
+    NEO4J_MAX_POOL_SIZE: int = 100
+    NEO4J_ACQ_TIMEOUT: float = 60.0 # seconds to wait for a free connection from the pool
+    NEO4J_MAX_LIFETIME: int = 3600 # seconds before a pooled connection gets recycled
+    NEO4J_CONNECTION_TIMEOUT: float = 30.0 # seconds to wait when opening a new connection
+
+    # twilio http connection pool, requests only keeps 10 connections alive by default
+    TWILIO_HTTP_POOL_SIZE: int = 50
+    TWILIO_HTTP_TIMEOUT: float = 10.0 # seconds
+    TWILIO_HTTP_MAX_RETRIES: int = 2
+
+    # cost factor for password hashing, measure before lowering it
+    BCRYPT_ROUNDS: int = 12
     
     model_config = SettingsConfigDict(env_file=".env")
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    """Builds the settings on first use so importing the app doesn't parse the .env file"""
+    return Settings()
+
+def __getattr__(name: str):
+    # PEP 562 lazy module attribute, keeps `config.settings` working without building it at import
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,33 +1,36 @@
 # external
 from fastapi import FastAPI, Depends, status
 from typing import Annotated
-from neo4j import GraphDatabase
-from twilio.rest import Client
+from neo4j import AsyncDriver, AsyncGraphDatabase
 from fastapi.middleware.cors import CORSMiddleware
 
 # internal 
 from app.services.auth import get_current_user
-from app.core.config import settings
+from app.core.config import get_settings
 from app.routes.auth import auth_router
 from app.routes.users import user_router
 from app.schemas.users import UserInDb
-from app.services.neo4j_db import get_neo4j_driver
+from app.services.neo4j_db import create_constraints, get_neo4j_driver
 
 async def lifespan(app: FastAPI):
     """Controls the lifespan of the app from startup to shutdown and properly manages the neccessary resources"""
+    settings = get_settings()
+
     # neo4j
-    driver = GraphDatabase.driver(settings.NEO4J_URI, auth=(settings.NEO4J_USERNAME, settings.NEO4J_PASSWORD))
-    session = driver.session(database="neo4j")
+    driver = AsyncGraphDatabase.driver(
+        settings.NEO4J_URI,
+        auth=(settings.NEO4J_USERNAME, settings.NEO4J_PASSWORD),
+        max_connection_pool_size=settings.NEO4J_MAX_POOL_SIZE,
+        connection_acquisition_timeout=settings.NEO4J_ACQ_TIMEOUT,
+        max_connection_lifetime=settings.NEO4J_MAX_LIFETIME,
+        connection_timeout=settings.NEO4J_CONNECTION_TIMEOUT,
+        keep_alive=True,
+    )
     app.state.neo4j_driver = driver
-    app.state.neo4j_session = session
-
-    # twilio
-    twilio_client = Client(settings.TWILIO_SID, settings.TWILIO_AUTH_TOKEN)
-    app.state.twilio_client = twilio_client
+    await create_constraints(driver)
 
     yield
-    session.close()
-    driver.close()
+    await driver.close()
 
 
 
@@ -52,9 +55,9 @@ async def root():
     return {"message": "Welcome to Connect3, a social network for UNC students. Built by M & P"}
 
 @app.get("/health", status_code=status.HTTP_200_OK)
-async def health(db: Annotated[GraphDatabase, Depends(get_neo4j_driver)]):
+async def health(db: Annotated[AsyncDriver, Depends(get_neo4j_driver)]):
     try:
-        db.verify_connectivity()
+        await db.verify_connectivity()
         db_status = "ok"
     except Exception as e:
         db_status = "error"
@@ -1,10 +1,12 @@
 # external 
 from typing import Annotated
+from cachetools import TTLCache
 from fastapi import APIRouter, Depends, HTTPException, status
-from neo4j import Session
+from neo4j import AsyncSession
+from twilio.rest import Client
 
 # internal
-from app.services.neo4j_db import check_connection, check_direct_connection, create_connection, find_shortest_path, get_neo4j_session, create_user_in_db, get_num_of_connections, get_user_graph, get_user_in_db, reduce_connection_count
+from app.services.neo4j_db import check_direct_connection, create_connection, find_shortest_path, get_neo4j_session, create_user_in_db, get_user_graph, get_user_in_db, UserRow
 from app.schemas.users import BaseUser, GraphResponse, UserConnections, UserInDb, UserPhonenumber
 from app.services.auth import get_current_user
 from app.services.twilio import get_twilio_client, send_sms
@@ -14,11 +16,20 @@ user_router = APIRouter(
     tags=["users"],
 )
 
+# (phonenumber, degrees) -> GraphResponse, a graph only changes when a connection is created
+_graph_cache = TTLCache(maxsize=5_000, ttl=30)
+
+def _invalidate_graph_cache(*phonenumbers: str):
+    """Drops every cached graph centered on any of the given users"""
+    for key in [key for key in _graph_cache if key[0] in phonenumbers]:
+        _graph_cache.pop(key, None)
+
 @user_router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_user(user: BaseUser, session: Session = Depends(get_neo4j_session)):
+async def create_user(user: BaseUser, session: AsyncSession = Depends(get_neo4j_session)):
     """Creates a user given a BaseUser """
     try: 
-        return await create_user_in_db(user, session)
+        created_user = await create_user_in_db(user, session)
+        return created_user.to_user_in_db()
     except ValueError as e:
         raise HTTPException(
             status_code=500,
@@ -26,21 +37,20 @@ async def create_user(user: BaseUser, session: Session = Depends(get_neo4j_sessi
         )
     
 @user_router.get("/me", response_model=UserInDb)
-async def get_current_user_route(current_user: Annotated[BaseUser, Depends(get_current_user)]):
+async def get_current_user_route(current_user: Annotated[UserRow, Depends(get_current_user)]):
     """Gets the current active user information"""
-    return current_user
+    return current_user.to_user_in_db()
 
 
 @user_router.post("/connect", status_code=status.HTTP_201_CREATED)
 async def create_connection_route(receiver: UserPhonenumber, 
-                                  current_user: Annotated[BaseUser, Depends(get_current_user)], session: Session = Depends(get_neo4j_session), 
-                                  twilio_client: Session = Depends(get_twilio_client)):
+                                  current_user: Annotated[UserRow, Depends(get_current_user)], session: AsyncSession = Depends(get_neo4j_session), 
+                                  twilio_client: Client = Depends(get_twilio_client)):
     """Creates a connection between the current user and the phone number. If the current_user has 0 remaining_connections, we throw an error. If we can't find the receiver, we create it in the DB and send a text message to the receiver"""
-    curr_phonenumber = UserPhonenumber(phonenumber=current_user.phonenumber)
-    remaining_connections = await get_num_of_connections(curr_phonenumber, session)
-
     # if the user has no remaining connections, we throw an error
-    if remaining_connections <= 0:
+    # current_user can be up to a few seconds stale (get_user_in_db caches it), so this only rejects the obvious case.
+    # The real check is the locked, guarded write in create_connection
+    if current_user.remaining_connections <= 0:
         raise HTTPException(
             status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
             detail="Cannot create connection. User has reached maximum connections."
@@ -71,43 +81,48 @@ async def create_connection_route(receiver: UserPhonenumber,
                 status_code=500,
                 detail=f"Server error: {str(e)}"
             )
+
+    # create the connection and take one of the user's remaining connections in a single transaction
     try:
-        if await check_direct_connection(user1=current_user, user2=receiver, session=session):
+        created = await create_connection(phone1=current_user.phonenumber, phone2=receiver.phonenumber, session=session)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Server error: {str(e)}"
+        )
+
+    if not created:
+        # nothing was created, figure out why. This extra query only runs when the connection fails
+        if await check_direct_connection(phone1=current_user.phonenumber, phone2=receiver.phonenumber, session=session):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Cannot create connection. Users are already directly connected."
             )
-    except ValueError as e:
         raise HTTPException(
-            status_code=500,
-            detail=f"Server error: {str(e)}"
+            status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
+            detail="Cannot create connection. User has reached maximum connections."
         )
 
-    # we know the user has remaining connections and the receiver user exists, and they are not already connected
-    # create the connection
-
-    try:
-        await create_connection(user1=current_user, user2=receiver, session=session)
-        updated_num_of_connection = await reduce_connection_count(user1=current_user, session=session)
-    except Exception as e:
-        return HTTPException(
-            status_code=500,
-            detail=f"Server error: {str(e)}"
-        )
+    _invalidate_graph_cache(current_user.phonenumber, receiver.phonenumber)
     
 @user_router.get("/graph", status_code=status.HTTP_200_OK)
-async def get_user_graph_route(current_user: Annotated[BaseUser, Depends(get_current_user)], session: Session = Depends(get_neo4j_session), degrees: int = 6) -> GraphResponse:
+async def get_user_graph_route(current_user: Annotated[UserRow, Depends(get_current_user)], session: AsyncSession = Depends(get_neo4j_session), degrees: int = 6) -> GraphResponse:
     """
     Returns the graph network where the current user is centered. Defaults to 6 when not provided.
     DO NOT USE MORE THAN 6 OR 7 IT WILL BREAK THE GRAPH.
     """
+    cache_key = (current_user.phonenumber, degrees)
+    cached_graph = _graph_cache.get(cache_key)
+    if cached_graph is not None:
+        return cached_graph
     try:
-        current_user_phonenumber = UserPhonenumber(phonenumber=current_user.phonenumber)
-        return await get_user_graph(
-            user1=current_user_phonenumber,
+        graph = await get_user_graph(
+            phonenumber=current_user.phonenumber,
             session=session,
             degrees=degrees
         )
+        _graph_cache[cache_key] = graph
+        return graph
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -115,24 +130,25 @@ async def get_user_graph_route(current_user: Annotated[BaseUser, Depends(get_cur
         )
 
 @user_router.get("/{phonenumber}", response_model=UserInDb, status_code=status.HTTP_200_OK)
-async def search_user(phonenumber: str, current_user: Annotated[BaseUser, Depends(get_current_user)], session: Session = Depends(get_neo4j_session)):
+async def search_user(phonenumber: str, current_user: Annotated[UserRow, Depends(get_current_user)], session: AsyncSession = Depends(get_neo4j_session)):
     """Searches for a user based on phone number, """
-    response: UserInDb = await get_user_in_db(phonenumber=phonenumber, session=session)
+    response = await get_user_in_db(phonenumber=phonenumber, session=session)
     if not response:
         raise HTTPException(
             status_code=404,
             detail="User not found in DB"
         )
     
-    return response
+    return response.to_user_in_db()
     
 @user_router.get("/{phonenumber}/shortest-path", status_code=status.HTTP_200_OK)
-async def get_shortest_path_to_user(phonenumber: str, current_user: Annotated[BaseUser, Depends(get_current_user)], session: Session = Depends(get_neo4j_session)) -> UserConnections:
+async def get_shortest_path_to_user(phonenumber: str, current_user: Annotated[UserRow, Depends(get_current_user)], session: AsyncSession = Depends(get_neo4j_session)) -> UserConnections:
     """Finds the shortest path to a certain user based on phone number. Returns a UserConnections model"""
+    # the path parameter is raw user input, so it still gets validated and normalized here
     receiver=UserPhonenumber(phonenumber=phonenumber)
 
     try:
-        return await find_shortest_path(user1=current_user, user2=receiver, session=session)
+        return await find_shortest_path(phone1=current_user.phonenumber, phone2=receiver.phonenumber, session=session)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
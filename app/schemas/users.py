@@ -7,9 +7,9 @@ from app.schemas.auth import Token
 from app.schemas.usphonenumber import USPhoneNumber
 class BaseUser(BaseModel):
     # base model for users
-    name: Optional[str] = str
+    name: Optional[str] = None
     phonenumber: USPhoneNumber
-    hashed_password: Optional[str] = str
+    hashed_password: Optional[str] = None
 
 class UserPhonenumber(BaseModel):
     """Just a User's phonenumber"""
@@ -60,11 +60,14 @@ class UserConnections(BaseModel):
         """
         Creates a UserConnections instance from a list of node objects.
         
-        Each node is assumed to be convertible to a dictionary of properties
-        that match the fields required by MinimalUser.
+        Each node is assumed to have the properties required by MinimalUser.
+        The nodes come from our own DB, so validation is skipped.
         """
-        connections = [MinimalUser(**dict(node)) for node in nodes]
-        return cls(connections=connections)
+        connections = [
+            MinimalUser.model_construct(user_id=node["user_id"], name=node["name"], phonenumber=node["phonenumber"])
+            for node in nodes
+        ]
+        return cls.model_construct(connections=connections)
 
 class GraphEdge(BaseModel):
     """Model that describes the edge between two users in the DB"""
@@ -1,79 +1,175 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
 from fastapi import HTTPException, status
 from typing import Annotated
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from neo4j import Session
-from datetime import timedelta, datetime
+from neo4j import AsyncSession
 import jwt
-from jwt.exceptions import InvalidTokenError
-from passlib.context import CryptContext
+from jwt.exceptions import DecodeError, ExpiredSignatureError, ImmatureSignatureError, InvalidSignatureError, InvalidTokenError
+import bcrypt
+from cachetools import TLRUCache, TTLCache
+from functools import lru_cache
 
 # internal
-from app.core.config import settings
-from app.services.neo4j_db import create_user_in_db, get_neo4j_session, get_user_in_db
-from app.schemas.users import BaseUser, SignUpUser, UserPhonenumber
+from app.core.config import get_settings
+from app.services.neo4j_db import UserRow, create_user_in_db, get_neo4j_session, get_user_in_db
+from app.schemas.users import BaseUser, SignUpUser
 from app.schemas.auth import Token, TokenData
 
-SECRET_KEY = settings.JWT_SECRET_KEY
+logger = logging.getLogger(__name__)
+
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+TOKEN_CACHE_TTL_SECONDS = 60
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def _token_ttu(token: str, value: tuple, now: float) -> float:
+    """A cached token lives for TOKEN_CACHE_TTL_SECONDS but never past its own exp claim"""
+    _, exp = value
+    if exp is None:
+        return now + TOKEN_CACHE_TTL_SECONDS
+    return min(exp, now + TOKEN_CACHE_TTL_SECONDS)
+
+# phone numbers that recently failed a login because no such user exists
+_missing_phone_cache = TTLCache(maxsize=50_000, ttl=5)
+
+# maps an already verified token to (phonenumber, exp) so repeat requests skip decoding it again
+_token_cache = TLRUCache(maxsize=10_000, ttu=_token_ttu, timer=time.time)
+
+@lru_cache
+def _signing_key() -> bytes:
+    """The JWT secret as bytes, encoded once"""
+    return get_settings().JWT_SECRET_KEY.encode()
+
+def _b64url_decode(segment: str) -> bytes:
+    """Decodes a base64url JWT segment, which comes without padding"""
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def decode_access_token(token: str) -> dict:
+    """
+    Verifies and decodes one of our HS256 tokens without going through PyJWT's generic decode path.
+    Tokens with any other alg are handed to jwt.decode, which rejects them since only HS256 is allowed.
+    Raises the same InvalidTokenError subclasses as jwt.decode.
+    """
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64url_decode(header_b64))
+    except ValueError as e:
+        raise DecodeError("Invalid token") from e
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        return jwt.decode(token, _signing_key(), algorithms=[ALGORITHM])
+
+    try:
+        signature = _b64url_decode(signature_b64)
+        expected = hmac.new(_signing_key(), f"{header_b64}.{payload_b64}".encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, signature):
+            raise InvalidSignatureError("Signature verification failed")
+        payload = json.loads(_b64url_decode(payload_b64))
+    except InvalidSignatureError:
+        raise
+    except ValueError as e:
+        raise DecodeError("Invalid token") from e
+    if not isinstance(payload, dict):
+        raise DecodeError("Invalid payload")
+
+    now = time.time()
+    exp = payload.get("exp")
+    if exp is not None:
+        if not isinstance(exp, (int, float)):
+            raise DecodeError("Expiration Time claim (exp) must be a number.")
+        if exp <= now:
+            raise ExpiredSignatureError("Signature has expired")
+    nbf = payload.get("nbf")
+    if nbf is not None:
+        if not isinstance(nbf, (int, float)):
+            raise DecodeError("Not Before claim (nbf) must be a number.")
+        if nbf > now:
+            raise ImmatureSignatureError("The token is not yet valid (nbf)")
+    return payload
 
 def create_access_token(data: dict) -> str:
     """ Create an JWT token with a set expiration time"""
 
     to_encode = data.copy()
 
-    expire = datetime.now() + timedelta(ACCESS_TOKEN_EXPIRE_MINUTES)
-    
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    # exp as an integer epoch, timezone independent and cheap for PyJWT to encode
+    to_encode.update({"exp": int(time.time()) + _EXPIRE_SECONDS})
+    encoded_jwt = jwt.encode(to_encode, get_settings().JWT_SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 def get_password_hash(password: str):
     """ Get the hashed password"""
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=get_settings().BCRYPT_ROUNDS)).decode()
 
 def verify_password(plain_password: str, hashed_password: str):
-    """Compares the plain password and the hashed password"""
-    return pwd_context.verify(plain_password, hashed_password)
+    """
+    Compares the plain password and the hashed password.
+    Pass an empty hash when there is no user, it's still compared against a dummy hash so the timing gives nothing away.
+    """
+    if not hashed_password:
+        # no user, or an unverified user without a password yet
+        bcrypt.checkpw(plain_password.encode(), _dummy_password_hash().encode())
+        return False
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
-def verify_phone_verification_token(token: Token, phonenumber: UserPhonenumber):
+@lru_cache
+def _dummy_password_hash() -> str:
+    """A hash with the configured cost, compared against when there is no user so a miss takes as long as a hit"""
+    return get_password_hash("connect3-dummy-password")
+
+def verify_phone_verification_token(token: Token, phonenumber: str):
     """Checks if a token is valid for a given phone number by decoding it"""
-    valid_token = jwt.decode(token.access_token, settings.JWT_SECRET_KEY, algorithms=[ALGORITHM])
-    print("valid_token:")
-    print(valid_token)
-    if valid_token.get("sub") == phonenumber.phonenumber:
+    valid_token = decode_access_token(token.access_token)
+    logger.debug("phone verification token for %s", valid_token.get("sub"))
+    if valid_token.get("sub") == phonenumber:
         return True
     return False
 
-async def authenticate_user(phonenumber: str, password: str, session: Session):
+async def authenticate_user(phonenumber: str, password: str, session: AsyncSession):
     """Determines if the user is valid or not based on the phone number"""
+    if phonenumber in _missing_phone_cache:
+        # repeated misses skip the DB, but still pay for a bcrypt compare to keep the timing flat
+        await asyncio.to_thread(verify_password, password, "")
+        return False
     user = await get_user_in_db(phonenumber=phonenumber, session=session)
     if not user:
+        _missing_phone_cache[phonenumber] = True
+        await asyncio.to_thread(verify_password, password, "")
         return False
-    if not verify_password(password, user.hashed_password):
+    # bcrypt is CPU bound so it runs in a thread to keep the event loop free
+    if not await asyncio.to_thread(verify_password, password, user.hashed_password):
         return False
     return user
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: Annotated[Session, Depends(get_neo4j_session)]):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: Annotated[AsyncSession, Depends(get_neo4j_session)]) -> UserRow:
     "Gets the current user"
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phonenumber: str = payload.get("sub")
-        if phonenumber is None:
+    cached = _token_cache.get(token)
+    if cached is not None:
+        phonenumber, _ = cached
+    else:
+        try:
+            payload = decode_access_token(token)
+            phonenumber: str = payload.get("sub")
+            if phonenumber is None:
+                raise credentials_exception
+            token_data = TokenData(phonenumber=phonenumber)
+        except InvalidTokenError:
             raise credentials_exception
-        token_data = TokenData(phonenumber=phonenumber)
-    except InvalidTokenError:
-        raise credentials_exception
+        _token_cache[token] = (phonenumber, payload.get("exp"))
     
     user = await get_user_in_db(phonenumber=phonenumber, session=session)
     if user is None:
@@ -82,23 +178,14 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], sessio
     return user
 
     
-async def signup_user_service(user: SignUpUser, session: Session):
+async def signup_user_service(user: SignUpUser, session: AsyncSession) -> UserRow:
     """
     Signs up a user
-    Checks if they exist, if they exist, raises an error
-    if not, calls neo4j_db to create the user
+    calls neo4j_db to create the user, which raises an error if a verified user already has this phone number
     Returns the user
     """
-    # checks if the user has a verified phone number. If they do have a phone number AND it's verified, we throw an error
-    existing_user = await get_user_in_db(phonenumber=user.phonenumber, session=session)
-    if existing_user and existing_user.is_verified:
-        raise HTTPException(
-        status_code=status.HTTP_400_BAD_REQUEST,
-        detail="A user with this phone number already exists and is verified."
-        )
-
     # now we need to create the user. First we hash the password
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await asyncio.to_thread(get_password_hash, user.password)
     # create the user we are going to input
     base_user = BaseUser(
         name=user.name,
@@ -108,5 +195,6 @@ async def signup_user_service(user: SignUpUser, session: Session):
 
     # create the user in the DB.
     created_user = await create_user_in_db(user=base_user, session=session)
+    _missing_phone_cache.pop(str(user.phonenumber), None)
     # return the created user with hashed password
     return created_user
\ No newline at end of file
@@ -6,33 +6,103 @@ General rule of thumb, all raw cypher queries get put in here
 """
 # external 
 import datetime
+import logging
+import uuid
+from dataclasses import asdict, dataclass
+from cachetools import TTLCache
 from fastapi import HTTPException, Request
-from neo4j import Session
+from neo4j import AsyncDriver, AsyncSession
+from neo4j.exceptions import DriverError, Neo4jError
 from typing import Optional
-from functools import lru_cache
 # internal 
-from app.schemas.users import BaseUser, GraphEdge, GraphResponse, MinimalUser, UserConnections, UserInDb, UserPhonenumber
+from app.schemas.users import BaseUser, GraphEdge, GraphResponse, MinimalUser, UserConnections, UserInDb
 from app.schemas.usphonenumber import USPhoneNumber
 
+logger = logging.getLogger(__name__)
+
+# phonenumber -> UserRow, read through by get_user_in_db and dropped by every write that changes a user
+_user_cache = TTLCache(maxsize=10_000, ttl=15)
+# what a property missing on an older User node reads as, the same values an unverified user is created with
+_USER_DEFAULTS = {"name": "", "hashed_password": "", "created_at": "", "remaining_connections": 0, "is_verified": False}
+
+# INTERNAL MODELS
+
+@dataclass(slots=True, frozen=True)
+class UserRow:
+    """
+    A user as read from the DB, passed between services and routes.
+    It's a plain dataclass so loading a user doesn't run the pydantic phone number validation,
+    routes turn it into a UserInDb with to_user_in_db() when they return it.
+    """
+    user_id: str
+    name: str
+    phonenumber: str
+    hashed_password: str
+    created_at: str
+    remaining_connections: int
+    is_verified: bool
+
+    def to_user_in_db(self) -> UserInDb:
+        """The API schema for this user"""
+        return UserInDb.model_construct(**asdict(self))
+
+    @classmethod
+    def from_node(cls, node) -> "UserRow":
+        """Builds a UserRow from a User node, taking only the declared fields so extra or missing properties don't break it"""
+        props = dict(node)
+        row = {field: props.get(field, _USER_DEFAULTS.get(field)) for field in cls.__slots__}
+        row["created_at"] = _created_at_str(row["created_at"])
+        return cls(**row)
+
 # HELPER METHODS
-@lru_cache
-def get_neo4j_driver(request: Request):
+async def get_neo4j_driver(request: Request):
     """ 
     Get the neo4j driver from the app state
     all subsequent requests will need to have a session injected into them which will then end up being a dependency for the request handler
     """
     return request.app.state.neo4j_driver
 
-@lru_cache
-def get_neo4j_session(request: Request):
-    """ 
-    Same as above driver but returns the session instead.
+async def get_neo4j_session(request: Request):
+    """Opens a session from the pooled driver for the duration of a single request"""
+    async with request.app.state.neo4j_driver.session(database="neo4j") as session:
+        yield session
+
+def _created_at_str(created_at) -> str:
+    """
+    created_at is a neo4j DateTime on new users and a string on users created before it was one.
+    New users come back as ISO 8601 with microseconds and an offset (2026-10-15T22:09:15.005983+00:00),
+    older users keep the str(datetime) format they were stored with (2026-10-15 22:09:15.005983).
     """
-    return request.app.state.neo4j_session
+    if isinstance(created_at, str):
+        return created_at
+    # iso_format() would give nanoseconds, which a lot of client date parsers reject
+    return created_at.to_native().isoformat()
+
+# SCHEMA
+
+async def create_constraints(driver: AsyncDriver):
+    """Creates the unique constraints on User at startup, failures are logged and never stop the app"""
+    queries = [
+        "CREATE CONSTRAINT user_phone_unique IF NOT EXISTS FOR (u:User) REQUIRE u.phonenumber IS UNIQUE",
+        "CREATE CONSTRAINT user_id_unique IF NOT EXISTS FOR (u:User) REQUIRE u.user_id IS UNIQUE",
+    ]
+    try:
+        async with driver.session(database="neo4j") as session:
+            for query in queries:
+                try:
+                    result = await session.run(query)
+                    await result.consume()
+                except Neo4jError as e:
+                    # e.g. duplicate phone numbers already in the DB, the app still works without the constraint
+                    logger.warning("Failed to create constraint: %s (%s)", query, e)
+    except DriverError as e:
+        # the DB isn't reachable yet, the app still boots so /health can report it.
+        # The constraints get created on the next startup that can reach the DB
+        logger.warning("Skipped creating constraints, could not reach Neo4j (%s)", e)
 
 # DB METHODS
 
-async def create_user_in_db(user: BaseUser, session: Session) -> UserInDb:
+async def create_user_in_db(user: BaseUser, session: AsyncSession) -> UserRow:
     """
     Create or update a user in the database based on phone number.
 
@@ -52,79 +122,79 @@ async def create_user_in_db(user: BaseUser, session: Session) -> UserInDb:
     # If both name and hashed_password are non-empty => verified user
     # Otherwise => unverified
     is_verified = bool(name and hashed_password)
-    # Check if a user with this phone number already exists
-    existing_user = await get_user_in_db(user.phonenumber, session=session)
-
-    if existing_user and existing_user.is_verified:
-        # User already exists and is verified, so we can't update it
-        raise HTTPException(
-            status_code=400,
-            detail="User already exists and is verified")
-    elif existing_user and not existing_user.is_verified and is_verified:
-        # Update the existing user node
-        query = """
-        MATCH (u:User {phonenumber: $phonenumber})
+    # A single MERGE both checks for an existing user and creates / updates it.
+    # user_id is generated here so we can tell from the result whether this query created the node.
+    # An existing unverified user only gets updated when the new data makes it verified.
+    # Writing _lock takes u's write lock before is_verified is read, so two signups racing for the same
+    # placeholder can't both claim it, the second one waits and then sees it verified.
+    query = """
+    MERGE (u:User {phonenumber: $phonenumber})
+    ON CREATE SET
+        u.user_id = $user_id,
+        u.name = $name,
+        u.hashed_password = $hashed_password,
+        u.created_at = $created_at,
+        u.remaining_connections = $remaining_connections,
+        u.is_verified = $is_verified
+    SET u._lock = true
+    REMOVE u._lock
+    WITH u, u.user_id = $user_id AS created, coalesce(u.is_verified, false) AS was_verified
+    FOREACH (_ IN CASE WHEN NOT created AND NOT was_verified AND $is_verified THEN [1] ELSE [] END |
         SET u.name = $name,
             u.hashed_password = $hashed_password,
             u.is_verified = $is_verified
-        RETURN u
-        """
-    elif existing_user and not existing_user.is_verified and not is_verified:
-        raise HTTPException(
-            status_code=400,
-            detail="User already exists but is not verified. Cannot update with incomplete data."
-        )
-    else:
-        # Create a new user node
-        query = """
-        CREATE (u:User {
-            user_id: randomUUID(),
-            name: $name,
-            phonenumber: $phonenumber,
-            hashed_password: $hashed_password,
-            created_at: $created_at,
-            remaining_connections: $remaining_connections,
-            is_verified: $is_verified
-        })
-        RETURN u
-        """
+    )
+    RETURN u, created, was_verified
+    """
 
     params = {
+        "user_id": str(uuid.uuid4()),
         "name": name,
         "phonenumber": str(user.phonenumber),
         "hashed_password": hashed_password,
         "is_verified": is_verified,
-        "created_at": str(datetime.datetime.now()),
+        # sent as a native neo4j datetime so it can be compared and range queried in cypher
+        "created_at": datetime.datetime.now(datetime.timezone.utc),
         "remaining_connections": 3
     }
 
-    result = session.run(query, **params)
-    record = result.single()
+    async def _create(tx):
+        result = await tx.run(query, **params)
+        return await result.single()
+
+    # user_id is fixed before the transaction, so a retried MERGE still recognises the node it created
+    record = await session.execute_write(_create)
+    _user_cache.pop(params["phonenumber"], None)
 
     if record is None:
         raise HTTPException(
             status_code=500,
             detail="Failed to create/update user in DB."
         )
-    
-    node = record["u"]
-    # Safely convert node properties to a UserInDb
-    created_user = UserInDb(
-        user_id=node["user_id"],
-        name=node.get("name", ""),
-        phonenumber=node["phonenumber"],
-        hashed_password=node.get("hashed_password", ""),
-        created_at=node.get("created_at", ""),
-        remaining_connections=int(node.get("remaining_connections", 0)),
-        is_verified=node.get("is_verified", False)
-    )
 
-    return created_user
+    if not record["created"]:
+        if record["was_verified"]:
+            # User already exists and is verified, so we can't update it
+            raise HTTPException(
+                status_code=400,
+                detail="User already exists and is verified")
+        if not is_verified:
+            raise HTTPException(
+                status_code=400,
+                detail="User already exists but is not verified. Cannot update with incomplete data."
+            )
+    
+    return UserRow.from_node(record["u"])
 
-async def get_user_in_db(phonenumber: str, session: Session) -> Optional[UserInDb]:
+async def get_user_in_db(phonenumber: str, session: AsyncSession) -> Optional[UserRow]:
     """
     Search for a user in the Neo4j database using the provided phone number
+    Hits are cached for a few seconds since almost every authenticated request looks up its user.
     """
+    cached_user = _user_cache.get(str(phonenumber))
+    if cached_user is not None:
+        return cached_user
+
     query = """
     MATCH (u:User {phonenumber: $phonenumber})
     RETURN u
@@ -132,75 +202,40 @@ async def get_user_in_db(phonenumber: str, session: Session) -> Optional[UserInD
     params = {
         "phonenumber": str(phonenumber)
     }
-    result = session.run(query, **params)
-    record = result.single()
+
+    async def _get(tx):
+        result = await tx.run(query, **params)
+        return await result.single()
+
+    record = await session.execute_read(_get)
 
     if record is None:
         # No user found with the given phone number.
         return None
     
-    node = record["u"]
-    found_user = UserInDb(
-        user_id=node["user_id"],
-        name=node["name"],
-        phonenumber=node["phonenumber"],
-        hashed_password=node["hashed_password"],
-        created_at=node["created_at"],
-        remaining_connections=node["remaining_connections"],
-        is_verified=(node["is_verified"] or True)
-    )
+    found_user = UserRow.from_node(record["u"])
+    _user_cache[found_user.phonenumber] = found_user
     return found_user
 
-async def check_connection(user1: UserPhonenumber, user2: UserPhonenumber, session: Session) -> bool:
+async def check_direct_connection(phone1: str, phone2: str, session: AsyncSession) -> bool:
     """
-    Checks if two users are connected by ANY PATH. 
-    user1 and user2 are both UserPhoneNumbers
+    Checks if two users are connected DIRECTLY aka A-B, in either direction since a friendship is stored as one edge.
+    EXISTS stops at the first matching edge and always gives one row, even for pairs still stored as two edges.
+    phone1 and phone2 are both already validated phone numbers
     """
     query = """
     MATCH (u1:User {phonenumber: $phone1}), (u2:User {phonenumber: $phone2})
-    OPTIONAL MATCH p = shortestPath((u1)-[:FRIENDS_WITH*]-(u2))
-    WITH p IS NOT NULL AS isConnected
-    RETURN isConnected
+    RETURN EXISTS { (u1)-[:FRIENDS_WITH]-(u2) } AS isConnected
     """
-    if user1.phonenumber == user2.phonenumber:
+    if phone1 == phone2:
         raise ValueError
 
-    # Extract phonenumber from each BaseUser
-    try:
-
-        phone1 = user1.phonenumber
-        phone2 = user2.phonenumber
-        result = session.run(query, phone1=phone1, phone2=phone2)
-        record = result.single()
-        if record:
-            return bool(record["isConnected"])
-
-        # If there's no record, consider them not connected
-        return False
-    except ValueError as e:
-        raise ValueError(e) from e
-
-async def check_direct_connection(user1: UserPhonenumber, user2: UserPhonenumber, session: Session) -> bool:
-    """
-    Checks if two users are connected DIRECTLY aka A->B. 
-    user1 and user2 are both UserPhoneNumbers
-    """
-    query = """
-    MATCH (u1:User {phonenumber: $phone1}), (u2:User {phonenumber: $phone2})
-    OPTIONAL MATCH (u1)-[r:FRIENDS_WITH]->(u2)
-    WITH r IS NOT NULL AS isConnected
-    RETURN isConnected
-    """
-    if user1.phonenumber == user2.phonenumber:
-        raise ValueError
+    async def _check(tx):
+        result = await tx.run(query, phone1=phone1, phone2=phone2)
+        return await result.single()
 
-    # Extract phonenumber from each BaseUser
     try:
-
-        phone1 = user1.phonenumber
-        phone2 = user2.phonenumber
-        result = session.run(query, phone1=phone1, phone2=phone2)
-        record = result.single()
+        record = await session.execute_read(_check)
         if record:
             return bool(record["isConnected"])
 
@@ -209,92 +244,73 @@ async def check_direct_connection(user1: UserPhonenumber, user2: UserPhonenumber
     except ValueError as e:
         raise ValueError(e) from e
 
-async def create_connection(user1: UserPhonenumber, user2: UserPhonenumber, session: Session):
+async def create_connection(phone1: str, phone2: str, session: AsyncSession) -> bool:
     """
-    Checks if there's any existing path between user1 and user2.
-    If no path exists, creates a FRIENDS_WITH relationship.
-    User1 is considered to be the sender, and user2 is the receiver 
-    we subtract -1 from the user1 
+    Creates a FRIENDS_WITH relationship between phone1 and phone2 and subtracts 1 from the sender's remaining_connections,
+    all in a single write query.
+    phone1 is considered to be the sender, and phone2 is the receiver 
+    MERGE already skips relationships that exist, so there's no separate check for an existing connection.
+    Nothing is written if the sender has no remaining connections.
+    A friendship is a single edge, every query reads FRIENDS_WITH without a direction.
     
     Returns:
-        bool: True if a new relationship was created, False if already connected.
+        bool: True if a new relationship was created, False otherwise.
     """
 
-    # checks that the two user1 and user2 are not the same 
-    if user1.phonenumber == user2.phonenumber:
+    # checks that the two phone numbers are not the same 
+    if phone1 == phone2:
         raise ValueError
 
-    # 1. Check if there's a direct path between them
-    if not await check_direct_connection(user1, user2, session):
-        # 2. No existing connection found, so create a new one
-        query = """
-        MATCH (u1:User {phonenumber: $phone1}), (u2:User {phonenumber: $phone2})
-        MERGE (u1)-[:FRIENDS_WITH]->(u2)
-        MERGE (u2)-[:FRIENDS_WITH]->(u1)
-        RETURN u1, u2
-        """
-        session.run(
+    # The WHERE alone reads remaining_connections before MERGE locks u1, so two parallel requests could both
+    # see the last connection. Writing _lock takes u1's write lock first (held until commit, even after the
+    # REMOVE), so a parallel request waits here and then reads the already decremented count.
+    query = """
+    MATCH (u1:User {phonenumber: $phone1}), (u2:User {phonenumber: $phone2})
+    SET u1._lock = true
+    REMOVE u1._lock
+    WITH u1, u2
+    WHERE u1.remaining_connections > 0
+    MERGE (u1)-[:FRIENDS_WITH]-(u2)
+    ON CREATE SET u1.remaining_connections = u1.remaining_connections - 1
+    """
+
+    async def _create(tx):
+        result = await tx.run(
             query,
-            phone1=user1.phonenumber,
-            phone2=user2.phonenumber
+            phone1=phone1,
+            phone2=phone2
         )
-        return True  # indicates a new relationship was created
+        return await result.consume()
 
-    # Already connected, do nothing
-    return False
+    summary = await session.execute_write(_create)
+    # the sender's remaining_connections may have changed
+    _user_cache.pop(phone1, None)
+    return summary.counters.relationships_created > 0
 
 
-async def get_connections(user1: UserPhonenumber, session: Session) -> UserConnections:
-    """Returns a UserConnections model which represents all of a user1's direct connections as well as number of connections"""
+async def get_connections(phonenumber: str, session: AsyncSession) -> UserConnections:
+    """Returns a UserConnections model which represents all of a user's direct connections as well as number of connections"""
     query = """
-    MATCH (u:User { phonenumber: $phone })-[:FRIENDS_WITH]->(c:User)
-    RETURN collect(c) AS connections
+    MATCH (u:User { phonenumber: $phone })-[:FRIENDS_WITH]-(c:User)
+    RETURN collect(DISTINCT c) AS connections
     """
-    result = session.run(query=query, phone=user1.phonenumber)
-    record = result.single()
+    async def _get(tx):
+        result = await tx.run(query, phone=phonenumber)
+        return await result.single()
+
+    record = await session.execute_read(_get)
 
     if record is None:
         return UserConnections(connections=[])
 
     connection_nodes = record["connections"] or []
-    connections_list = []
-    for node in connection_nodes:
-        connections_list.append(
-            MinimalUser(
-                id=node["user_id"],
-                name=node["name"],
-                phonenumber=node["phonenumber"]
-            )
-        )
-    return UserConnections(connections=connections_list)
+    connections_list = [
+        MinimalUser.model_construct(user_id=props["user_id"], name=props["name"], phonenumber=props["phonenumber"])
+        for props in map(dict, connection_nodes)
+    ]
+    return UserConnections.model_construct(connections=connections_list)
 
-async def get_num_of_connections(user1: UserPhonenumber, session: Session) -> int: 
-    """Gets remaining_connections of a user """
-
-    user = await get_user_in_db(user1.phonenumber, session=session)
-    if not user:
-        # couldn't find the user
-        return ValueError
-    
-    return user.remaining_connections
-
-async def reduce_connection_count(user1: UserPhonenumber, session: Session):
-    """Reduce the connection count by 1 of a user"""
-    current_count = await get_num_of_connections(user1=user1, session=session)
-    if current_count <= 0:
-        raise ValueError
-    
-    query_update = """
-    MATCH (u:User {phonenumber: $phone})
-    SET u.remaining_connections = u.remaining_connections - 1
-    RETURN u.remaining_connections AS updated_rc
-    """
-    update_result = session.run(query_update, phone=user1.phonenumber)
-    update_record = update_result.single()
-    # Optionally return the new value, or just return None if you don’t need it
-    return update_record["updated_rc"]
-
-async def find_shortest_path(user1: UserPhonenumber, user2: UserPhonenumber, session: Session) -> UserConnections:
+async def find_shortest_path(phone1: str, phone2: str, session: AsyncSession) -> UserConnections:
     """Finds the shortest path between two users and returns a list of all users in between. Returns a UserConnections class"""
     
     query = """
@@ -303,12 +319,15 @@ async def find_shortest_path(user1: UserPhonenumber, user2: UserPhonenumber, ses
     MATCH path = shortestPath((u1)-[:FRIENDS_WITH*]-(u2))
     RETURN nodes(path) AS userConnections
     """
-    result = session.run(
-        query,
-        user1_phonenumber=user1.phonenumber,
-        user2_phonenumber=user2.phonenumber,
-    )
-    record = result.single()
+    async def _find(tx):
+        result = await tx.run(
+            query,
+            user1_phonenumber=phone1,
+            user2_phonenumber=phone2,
+        )
+        return await result.single()
+
+    record = await session.execute_read(_find)
     if record:
         # Process the record to convert it into your UserConnections class.
         nodes = record["userConnections"]
@@ -319,36 +338,30 @@ async def find_shortest_path(user1: UserPhonenumber, user2: UserPhonenumber, ses
         # Handle the case when no path is found
         raise ValueError("No connection path found between the two users.")
 
-async def get_user_graph(user1: UserPhonenumber, session: Session, degrees: int = 6) -> GraphResponse:
+async def get_user_graph(phonenumber: str, session: AsyncSession, degrees: int = 6) -> GraphResponse:
     """Gets a user's graph database to a certain number of degrees. Assumed to be 6 in this case."""
     degrees_int = int(degrees)  # Ensure it's an integer
     if degrees_int < 1:
         raise ValueError
     
-    query = f"""
-    MATCH path = (user:User {{phonenumber: $phone}})-[:FRIENDS_WITH*1..{degrees_int}]-(other)
-    RETURN path"""
-    result = session.run(query=query, phone=user1.phonenumber, degrees=degrees)
-
-    nodes_dict = {}
-    edges_set = set()
-    for record in result:
-        path = record["path"]
-        # Extract nodes
-        for node in path.nodes:
-            # Assuming each node has an 'id' field
-            node_id = node.get("user_id")
-            if node_id not in nodes_dict:
-                # Convert node to dict if needed (Neo4j objects often provide a ._properties or similar)
-                node_data = dict(node)
-                nodes_dict[node_id] = MinimalUser(**node_data)
-        # Extract relationships as edges
-        for rel in path.relationships:
-            source_id = rel.start_node.get("user_id")
-            target_id = rel.end_node.get("user_id")
-            edges_set.add((source_id, target_id))
-
-    # Convert edge tuples to GraphEdge models
-    edges = [GraphEdge(source=src, target=target) for src, target in edges_set]
-    return GraphResponse(nodes=list(nodes_dict.values()), edges=edges)
-    
+    query = """
+    MATCH (user:User {phonenumber: $phone})
+    CALL apoc.path.subgraphAll(user, {relationshipFilter: 'FRIENDS_WITH', maxLevel: $degrees, bfs: true})
+    YIELD nodes, relationships
+    RETURN [n IN nodes | n {.user_id, .name, .phonenumber}] AS nodes,
+           [r IN relationships | {source: startNode(r).user_id, target: endNode(r).user_id}] AS edges
+    """
+
+    async def _read(tx):
+        result = await tx.run(query, phone=phonenumber, degrees=degrees_int)
+        return await result.single()
+
+    record = await session.execute_read(_read)
+    if record is None:
+        # the user doesn't exist
+        return GraphResponse.model_construct(nodes=[], edges=[])
+
+    nodes = [MinimalUser.model_construct(**props) for props in record["nodes"]]
+    edges = [GraphEdge.model_construct(**edge) for edge in record["edges"]]
+
+    return GraphResponse.model_construct(nodes=nodes, edges=edges)
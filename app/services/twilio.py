@@ -1,37 +1,57 @@
 """This file manages all the Twilio Services"""
 
 # external
+import asyncio
+import logging
 from fastapi import Request
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
-from functools import lru_cache
 # internal
-from app.core.config import settings
+from app.core.config import get_settings
 from app.schemas.twilio import TwilioVerificationModel, VerifyOTPModel
 from app.schemas.users import UserPhonenumber
 from app.schemas.usphonenumber import USPhoneNumber
 
-@lru_cache
-def get_twilio_client(request: Request) -> Client:
-    """returns a shared twilio client"""
+logger = logging.getLogger(__name__)
 
-    return request.app.state.twilio_client
+async def get_twilio_client(request: Request) -> Client:
+    """returns a shared twilio client, built on first use and kept on the app state"""
+    client = getattr(request.app.state, "twilio_client", None)
+    # no await between the check and the assignment, so no lock is needed
+    if client is None:
+        settings = get_settings()
+        # one pooled http session per worker, shared by every twilio call
+        http_client = TwilioHttpClient(pool_connections=True, timeout=settings.TWILIO_HTTP_TIMEOUT)
+        http_client.session.mount("https://", HTTPAdapter(
+            pool_maxsize=settings.TWILIO_HTTP_POOL_SIZE,
+            max_retries=settings.TWILIO_HTTP_MAX_RETRIES,
+        ))
+        client = Client(settings.TWILIO_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client)
+        request.app.state.twilio_client = client
+    return client
 
-@lru_cache
-def get_twilio_service(request: Request):
+async def get_twilio_service(request: Request):
     """Return the connect3 service. No dependency injection needed since we only have one service and there's no need to OOP this"""
-    return request.app.state.twilio_client.verify.v2.services(
-        sid=settings.TWILIO_PHONEAUTH_SERVICE_SID # This is the service sid for the phone auth service
-    )
+    service = getattr(request.app.state, "twilio_service", None)
+    if service is None:
+        client = await get_twilio_client(request)
+        service = client.verify.v2.services(
+            sid=get_settings().TWILIO_PHONEAUTH_SERVICE_SID # This is the service sid for the phone auth service
+        )
+        request.app.state.twilio_service = service
+    return service
 
 
-def send_OTP_text(phonenumber: UserPhonenumber, service: Client) -> TwilioVerificationModel:
+async def send_OTP_text(phonenumber: UserPhonenumber, service: Client) -> TwilioVerificationModel:
     """
     Sends out verification text to the given phonenumber. 
     The phone number MUST have a +1 modifier in front of it. This verification service does not add it for you.
     returns the STATUS
     """
     try: 
-        verification = service.verifications.create(  
+        verification = await asyncio.to_thread(
+        service.verifications.create,
         to=str(phonenumber.phonenumber),
         channel="sms"
         )
@@ -43,15 +63,16 @@ def send_OTP_text(phonenumber: UserPhonenumber, service: Client) -> TwilioVerifi
         date_updated=verification.date_updated
     )
     except Exception as e:
-        print(str(e))
+        logger.warning("failed to send OTP: %s", e)
         raise Exception(e)
 
-def verify_OTP_text(verification_code: VerifyOTPModel, service: Client) -> TwilioVerificationModel:
+async def verify_OTP_text(verification_code: VerifyOTPModel, service: Client) -> TwilioVerificationModel:
     """
     Verifies the OTP for a given phone number.
     the phone number MUST have the +1 modifier in front of it. This verification service does not add it for you
     """
-    verification_check = service.verification_checks.create(  # Removed await, as this is a synchronous call
+    verification_check = await asyncio.to_thread(
+        service.verification_checks.create,
         to=str(verification_code.phonenumber),
         code=verification_code.code
     )
@@ -63,16 +84,17 @@ def verify_OTP_text(verification_code: VerifyOTPModel, service: Client) -> Twili
         date_updated=verification_check.date_updated
     )
 
-def send_sms(message: str, to: USPhoneNumber, client: Client):
+async def send_sms(message: str, to: USPhoneNumber, client: Client):
     if not message or message == "":
         raise Exception("Message cannot be empty")
     
-    response = client.messages.create(
+    response = await asyncio.to_thread(
+    client.messages.create,
     body=message, 
     from_="+19192149053",
     to=to,)
     
-    if response.body.get("status") == "failed":
+    if response.status == "failed":
         raise Exception("Failed to send Message")
 
 